@@ -144,6 +144,14 @@ label_key = "*.tif"
 train_rois = None
 val_rois = None
 
+# Set to True to train from a few large shard files instead of the individual tif files.
+# See `Sequential-read shards` below for the details.
+use_shards = False
+
+# Set to True to only fine-tune the last checkpoint on new or changed training data instead of training from scratch.
+# See `Incremental fine-tuning` below for the details.
+incremental = False
+
 # example 1: Use training raw data and labels stored as tif-images in separate folders.
 # The example is formulated using the data from the `dsb` dataset.
 
@@ -269,7 +277,9 @@ def get_tiff_shapes(root_folder):
 
 # Call the function with the root folder path
 root_folder = "/content/drive/MyDrive/training_data"  # Adjust if necessary
-get_tiff_shapes(root_folder)
+# this reads every file, so it is skipped when training from shards or in incremental mode
+if not (use_shards or incremental):
+    get_tiff_shapes(root_folder)
 
 import imageio
 
@@ -297,7 +307,10 @@ def check_data(data_paths, label_paths, rois):
         print("Loading the dataset failed with:")
         raise e
 
-if preconfigured_dataset is None:
+if preconfigured_dataset is None and incremental:
+    # in incremental mode only the new or changed files are loaded, the full dataset check is skipped
+    print("Using a custom dataset in incremental mode, skipping the dataset check")
+elif preconfigured_dataset is None:
     print("Using a custom dataset:")
     print("Checking the training dataset:")
     check_data(train_data_paths, train_label_paths, train_rois)
@@ -366,15 +379,16 @@ metric = "dice"
 import os
 
 # Check the number of files in each folder
-num_train_raw_images = len([f for f in os.listdir(train_data_paths) if f.endswith('.tif')])
-num_train_label_images = len([f for f in os.listdir(train_label_paths) if f.endswith('.tif')])
-num_val_raw_images = len([f for f in os.listdir(val_data_paths) if f.endswith('.tif')])
-num_val_label_images = len([f for f in os.listdir(val_label_paths) if f.endswith('.tif')])
+if not incremental:
+    num_train_raw_images = len([f for f in os.listdir(train_data_paths) if f.endswith('.tif')])
+    num_train_label_images = len([f for f in os.listdir(train_label_paths) if f.endswith('.tif')])
+    num_val_raw_images = len([f for f in os.listdir(val_data_paths) if f.endswith('.tif')])
+    num_val_label_images = len([f for f in os.listdir(val_label_paths) if f.endswith('.tif')])
 
-print("Number of training raw images:", num_train_raw_images)
-print("Number of training label images:", num_train_label_images)
-print("Number of validation raw images:", num_val_raw_images)
-print("Number of validation label images:", num_val_label_images)
+    print("Number of training raw images:", num_train_raw_images)
+    print("Number of training label images:", num_train_label_images)
+    print("Number of validation raw images:", num_val_raw_images)
+    print("Number of validation label images:", num_val_label_images)
 
 from torch.utils.data import DataLoader
 
@@ -444,6 +458,321 @@ metric_function = get_loss(metric)
 if metric == "ce":
     metric_function = torch_em.loss.LossWrapper(metric_function, transform=lambda x, y: (x, torch.squeeze(y, 1).long()))
 
+"""## Sequential-read shards
+
+Reading thousands of small tif files from google drive (or another network filesystem) is slow, because every file is a separate random read. Instead, the raw / mask pairs can be packed into a few large shard files once. Each shard stores the tif files back-to-back and `index.json` records the byte offset and length of every raw image and mask, so a whole shard is read in one sequential read.
+
+The training loader then streams the shards: every data loader worker reads its own subset of the shards and samples are drawn from a shuffle buffer.
+Raw images and masks are matched by filename after removing `raw_suffix` / `label_suffix`, e.g. `s300-1-raw.tif` and `s300-1-true-mask.tif`.
+`index.json` also records the name, size and modification time of every source file. The shards are rebuilt whenever this no longer matches the files in the training data folders, e.g. after annotators added or changed masks.
+"""
+
+# CONFIGURE ME
+train_shard_folder = f"{data_path}/shards/train"
+val_shard_folder = f"{data_path}/shards/test"
+raw_suffix = "-raw"
+label_suffix = "-true-mask"
+images_per_shard = 256
+shuffle_buffer = 512
+num_workers = 2
+
+import io
+import json
+import imageio
+import torch
+
+def get_sample_name(filename, suffix):
+    name = os.path.splitext(filename)[0]
+    return name[:-len(suffix)] if name.endswith(suffix) else name
+
+def get_source_stats(data_folder, label_folder):
+    stats = {}
+    for key, folder in (("raw", data_folder), ("mask", label_folder)):
+        for f in os.listdir(folder):
+            if f.endswith(".tif"):
+                stat = os.stat(os.path.join(folder, f))
+                stats[f"{key}/{f}"] = [stat.st_size, stat.st_mtime]
+    return stats
+
+def shards_up_to_date(data_folder, label_folder, shard_folder):
+    index_path = os.path.join(shard_folder, "index.json")
+    if not os.path.exists(index_path):
+        return False
+    with open(index_path) as f:
+        sources = json.load(f)["sources"]
+    return sources == get_source_stats(data_folder, label_folder)
+
+def write_shards(data_folder, label_folder, shard_folder, images_per_shard=256):
+    raw_files = {get_sample_name(f, raw_suffix): f for f in os.listdir(data_folder) if f.endswith(".tif")}
+    label_files = {get_sample_name(f, label_suffix): f for f in os.listdir(label_folder) if f.endswith(".tif")}
+    names = sorted(set(raw_files) & set(label_files))
+    unmatched = set(raw_files) ^ set(label_files)
+    if unmatched:
+        print("Skipping", len(unmatched), "images without a matching raw image or mask:", sorted(unmatched))
+    assert names, f"No matching raw images and masks found in {data_folder} and {label_folder}"
+
+    os.makedirs(shard_folder, exist_ok=True)
+    # remove the old index first, so that an interrupted rebuild does not leave behind shards that look valid
+    index_path = os.path.join(shard_folder, "index.json")
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    sources = get_source_stats(data_folder, label_folder)
+
+    index = []
+    for shard_id, start in enumerate(range(0, len(names), images_per_shard)):
+        shard_file = f"shard-{shard_id:04d}.bin"
+        samples = []
+        with open(os.path.join(shard_folder, shard_file), "wb") as f_out:
+            for name in names[start:start + images_per_shard]:
+                sample = {"name": name}
+                for key, folder, files in (("raw", data_folder, raw_files), ("mask", label_folder, label_files)):
+                    with open(os.path.join(folder, files[name]), "rb") as f_in:
+                        content = f_in.read()
+                    sample[key] = [f_out.tell(), len(content)]
+                    f_out.write(content)
+                samples.append(sample)
+        index.append({"file": shard_file, "samples": samples})
+
+    with open(index_path, "w") as f:
+        json.dump({"sources": sources, "shards": index}, f)
+    print("Wrote", len(names), "samples to", len(index), "shards in", shard_folder)
+
+def pad_to_patch_shape(data, patch_shape):
+    # pad images that are smaller than the patch shape, like the torch_em loaders do with `with_padding=True`
+    shape = data.shape[-len(patch_shape):]
+    if all(sh >= ps for sh, ps in zip(shape, patch_shape)):
+        return data
+    pad_width = [(0, 0)] * (data.ndim - len(patch_shape)) + [(0, max(ps - sh, 0)) for sh, ps in zip(shape, patch_shape)]
+    return np.pad(data, pad_width)
+
+def get_patch(dataset, raw, labels, rng):
+    """
+    Sample a random patch and apply the transformations of `dataset` to it.
+    """
+    raw = pad_to_patch_shape(raw, dataset.patch_shape)
+    labels = pad_to_patch_shape(labels, dataset.patch_shape)
+
+    # the patch is sampled from the last axes, so that images with a leading channel axis, e.g. (1, H, W), also work
+    shape = raw.shape[-len(dataset.patch_shape):]
+    bb = tuple(slice(st, st + ps) for st, ps in zip(
+        (rng.integers(0, sh - ps + 1) for sh, ps in zip(shape, dataset.patch_shape)), dataset.patch_shape
+    ))
+    raw, labels = raw[(..., *bb)], labels[(..., *bb)]
+
+    # same order of transformations as in the torch_em datasets
+    if dataset.raw_transform is not None:
+        raw = dataset.raw_transform(raw)
+    if dataset.label_transform is not None:
+        labels = dataset.label_transform(labels)
+    if dataset.transform is not None:
+        raw, labels = dataset.transform(raw, labels)
+    if dataset.label_transform2 is not None:
+        labels = dataset.label_transform2(labels)
+
+    raw = torch_em.util.ensure_tensor_with_channels(raw, ndim=dataset.ndim, dtype=torch.float32)
+    labels = torch_em.util.ensure_tensor_with_channels(labels, ndim=dataset.ndim, dtype=torch.float32)
+    return raw, labels
+
+class ShardDataset(torch.utils.data.IterableDataset):
+    """
+    Dataset that streams random patches from the shards written by `write_shards`.
+    """
+    def __init__(self, shard_folder, patch_shape, raw_transform=None, label_transform=None,
+                 label_transform2=None, transform=None, ndim=2, shuffle_buffer=512):
+        with open(os.path.join(shard_folder, "index.json")) as f:
+            self.index = json.load(f)["shards"]
+        self.shard_folder = shard_folder
+        self.patch_shape = patch_shape
+        self.raw_transform = raw_transform
+        self.label_transform = label_transform
+        self.label_transform2 = label_transform2
+        self.transform = transform
+        self.ndim = ndim
+        self.shuffle_buffer = shuffle_buffer
+
+    def __len__(self):
+        return sum(len(shard["samples"]) for shard in self.index)
+
+    def _read_shard(self, shard):
+        # the samples are kept as encoded tif bytes, so that the shuffle buffer does not hold decoded images
+        with open(os.path.join(self.shard_folder, shard["file"]), "rb") as f:
+            content = f.read()
+        for sample in shard["samples"]:
+            (raw_offset, raw_size), (mask_offset, mask_size) = sample["raw"], sample["mask"]
+            yield content[raw_offset:raw_offset + raw_size], content[mask_offset:mask_offset + mask_size]
+
+    def _get_patch(self, raw_bytes, mask_bytes, rng):
+        raw = imageio.imread(io.BytesIO(raw_bytes))
+        labels = imageio.imread(io.BytesIO(mask_bytes))
+        return get_patch(self, raw, labels, rng)
+
+    def __iter__(self):
+        # each worker reads a disjoint subset of the shards
+        shards = self.index
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            shards = shards[worker_info.id::worker_info.num_workers]
+
+        rng = np.random.default_rng()
+        buffer = []
+        for shard_id in rng.permutation(len(shards)):
+            for sample in self._read_shard(shards[shard_id]):
+                buffer.append(sample)
+                if len(buffer) >= self.shuffle_buffer:
+                    # swap a random sample to the end, so that removing it from the buffer is cheap
+                    i = rng.integers(len(buffer))
+                    buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                    yield self._get_patch(*buffer.pop(), rng)
+        for i in rng.permutation(len(buffer)):
+            yield self._get_patch(*buffer[i], rng)
+
+def get_shard_loader(shard_folder, patch_shape, batch_size, label_transform=None, label_transform2=None,
+                     ndim=2, shuffle_buffer=512, num_workers=0):
+    dataset = ShardDataset(
+        shard_folder, patch_shape,
+        raw_transform=torch_em.transform.raw.standardize,
+        label_transform=label_transform, label_transform2=label_transform2,
+        transform=torch_em.transform.get_augmentations(ndim=ndim),
+        ndim=ndim, shuffle_buffer=shuffle_buffer
+    )
+    # the shards are shuffled by the dataset itself, the loader must not shuffle an iterable dataset
+    return torch_em.segmentation.get_data_loader(dataset, batch_size, num_workers=num_workers)
+
+if use_shards and preconfigured_dataset is None:
+    shard_folders = [(val_data_paths, val_label_paths, val_shard_folder)]
+    # in incremental mode the training data is loaded with the weighted loader instead of the shards
+    if not incremental:
+        shard_folders.append((train_data_paths, train_label_paths, train_shard_folder))
+    for data_folder, label_folder, shard_folder in shard_folders:
+        if not shards_up_to_date(data_folder, label_folder, shard_folder):
+            print("The shards in", shard_folder, "are missing or out of date, rebuilding them")
+            write_shards(data_folder, label_folder, shard_folder, images_per_shard)
+
+"""## Incremental fine-tuning
+
+If `incremental` is set to True (in the `Training Data` section), the network is not trained from scratch and the cells that read the full dataset are skipped. Instead:
+- the file hashes of all raw images and masks are compared to the manifest written by the previous run (`manifest_path`), to find the new and changed images. The manifest also stores the size and modification time of each file, and only the files for which these changed are read and hashed again.
+- the weights of the previous run, which are saved to `checkpoint_folder` next to the manifest and recorded in it, are loaded into the network.
+- the network is fine-tuned for `finetune_iterations` iterations with a training loader that replaces the default loader; the training images are sampled with a weight of `new_image_weight` for new or changed images and with their validation score (the `metric`, lower is better) otherwise, so that poorly segmented images are seen more often. The scores are divided by the worst score, so that they are on the same scale as `new_image_weight` for every `metric`.
+
+After training, only the new or changed images, the `n_revalidate_worst` training images with the worst score and the `n_revalidate_oldest` training images that were validated the longest time ago are validated again (see `Update the manifest` below); the other images keep their previous score. Validating the oldest scores in every run makes sure that images that got worse during fine-tuning are eventually found. Set `revalidate_all` to True to validate all images again.
+
+The manifest is written in every run with a custom dataset, so you need one full training run before you can use the incremental mode.
+"""
+
+# CONFIGURE ME
+manifest_path = f"{data_path}/manifest.json"
+# The weights that belong to the scores in the manifest are saved here, this should be on your google drive
+# so that they are still available in the next session.
+checkpoint_folder = f"{data_path}/checkpoints"
+finetune_iterations = 200
+new_image_weight = 1.0
+# images that are segmented well are still sampled with this minimal weight
+min_image_weight = 0.05
+n_revalidate_worst = 10
+n_revalidate_oldest = 50
+revalidate_all = False
+num_finetune_workers = 2
+
+import hashlib
+
+def hash_file(path):
+    hash_ = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hash_.update(chunk)
+    return hash_.hexdigest()
+
+def get_file_stat(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+def get_image_files(split, data_folder, label_folder):
+    """
+    Map the sample key (e.g. 'train/s300-1') to the raw image and mask file of all matching images.
+    """
+    raw_files = {get_sample_name(f, raw_suffix): f for f in os.listdir(data_folder) if f.endswith(".tif")}
+    label_files = {get_sample_name(f, label_suffix): f for f in os.listdir(label_folder) if f.endswith(".tif")}
+    return {
+        f"{split}/{name}": (os.path.join(data_folder, raw_files[name]), os.path.join(label_folder, label_files[name]))
+        for name in sorted(set(raw_files) & set(label_files))
+    }
+
+class ImageListDataset(torch.utils.data.Dataset):
+    """
+    Dataset that samples one random patch per raw image / mask file pair.
+    """
+    def __init__(self, image_files, patch_shape, raw_transform=None, label_transform=None,
+                 label_transform2=None, transform=None, ndim=2):
+        self.image_files = image_files
+        self.patch_shape = patch_shape
+        self.raw_transform = raw_transform
+        self.label_transform = label_transform
+        self.label_transform2 = label_transform2
+        self.transform = transform
+        self.ndim = ndim
+
+    def __len__(self):
+        return len(self.image_files)
+
+    def __getitem__(self, index):
+        raw_path, label_path = self.image_files[index]
+        return get_patch(self, imageio.imread(raw_path), imageio.imread(label_path), np.random.default_rng())
+
+def get_weighted_loader(image_files, weights, patch_shape, batch_size, label_transform=None, label_transform2=None,
+                        ndim=2, num_workers=0):
+    dataset = ImageListDataset(
+        image_files, patch_shape,
+        raw_transform=torch_em.transform.raw.standardize,
+        label_transform=label_transform, label_transform2=label_transform2,
+        transform=torch_em.transform.get_augmentations(ndim=ndim),
+        ndim=ndim
+    )
+    sampler = torch.utils.data.WeightedRandomSampler(weights, num_samples=len(image_files), replacement=True)
+    return torch_em.segmentation.get_data_loader(dataset, batch_size, sampler=sampler, num_workers=num_workers)
+
+manifest = {"images": {}}
+if preconfigured_dataset is None and os.path.exists(manifest_path):
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+image_files, image_stats, image_hashes, changed_images = {}, {}, {}, set()
+if preconfigured_dataset is None:
+    image_files.update(get_image_files("train", train_data_paths, train_label_paths))
+    image_files.update(get_image_files("test", val_data_paths, val_label_paths))
+
+    # reading the files from google drive is slow, so we only hash the files whose size or modification time changed
+    n_hashed = 0
+    for key, paths in image_files.items():
+        image_stats[key] = [get_file_stat(path) for path in paths]
+        previous = manifest["images"].get(key)
+        if previous is not None and previous.get("stats") == image_stats[key]:
+            image_hashes[key] = previous["hashes"]
+        else:
+            image_hashes[key] = [hash_file(path) for path in paths]
+            n_hashed += 1
+    print("Hashed", n_hashed, "of", len(image_files), "images")
+
+if incremental:
+    assert preconfigured_dataset is None, "The incremental mode is only supported for custom datasets"
+    assert manifest["images"], f"No manifest found at {manifest_path}, you need to run a full training first"
+    changed_images = {
+        key for key, hashes in image_hashes.items()
+        if key not in manifest["images"] or manifest["images"][key]["hashes"] != hashes
+    }
+    print("Found", len(changed_images), "new or changed images out of", len(image_hashes))
+
+    # the weighted training loader is created together with the other loaders below
+    train_keys = [key for key in image_files if key.startswith("train/")]
+    train_image_files = [image_files[key] for key in train_keys]
+    # normalise the scores by the worst score, so that they are on the same scale as `new_image_weight`
+    max_score = max((manifest["images"][key]["score"] for key in train_keys if key not in changed_images), default=0.0)
+    train_weights = [
+        new_image_weight if key in changed_images
+        else max(manifest["images"][key]["score"] / max_score if max_score > 0 else 0.0, min_image_weight)
+        for key in train_keys
+    ]
+
 kwargs = dict(
     patch_shape=patch_shape
 ) # removed batch_size from here
@@ -456,14 +785,26 @@ kwargs = dict(
 ds = preconfigured_dataset
 
 if ds is None:
-    train_loader = torch_em.default_segmentation_loader(
-        train_data_paths, data_key, train_label_paths, label_key,
-        rois=train_rois, **kwargs
-    )
-    val_loader = torch_em.default_segmentation_loader(
-        val_data_paths, data_key, val_label_paths, label_key,
-        rois=val_rois, **kwargs
-    )
+    if incremental:
+        train_loader = get_weighted_loader(train_image_files, train_weights, num_workers=num_finetune_workers, **kwargs)
+    elif use_shards:
+        train_loader = get_shard_loader(
+            train_shard_folder, shuffle_buffer=shuffle_buffer, num_workers=num_workers, **kwargs
+        )
+    else:
+        train_loader = torch_em.default_segmentation_loader(
+            train_data_paths, data_key, train_label_paths, label_key,
+            rois=train_rois, **kwargs
+        )
+    if use_shards:
+        val_loader = get_shard_loader(
+            val_shard_folder, shuffle_buffer=shuffle_buffer, num_workers=num_workers, **kwargs
+        )
+    else:
+        val_loader = torch_em.default_segmentation_loader(
+            val_data_paths, data_key, val_label_paths, label_key,
+            rois=val_rois, **kwargs
+        )
 else:
     kwargs.update(dict(download=True))
     if ds == "covid_if":
@@ -560,6 +901,16 @@ model = UNet2d(
     in_channels=in_channels, out_channels=out_channels, depth=depth, final_activation=final_activation
 )
 
+if incremental:
+    checkpoint_path = manifest.get("checkpoint")
+    if checkpoint_path is None or not os.path.exists(checkpoint_path):
+        raise FileNotFoundError(
+            f"The checkpoint {checkpoint_path} of the previous run recorded in {manifest_path} does not exist, "
+            "you need to run a full training first"
+        )
+    print("Warm-starting from", checkpoint_path)
+    model.load_state_dict(torch.load(checkpoint_path, map_location="cpu")["model_state"])
+
 """## Tensorboard
 
 Start the tensorboard in order to keep track of the training progress.
@@ -593,13 +944,13 @@ This also starts the training!
 
 # CONFIGURE ME
 experiment_name = "2D-UNet-14Jan25-1"
-n_iterations = 1000
+n_iterations = finetune_iterations if incremental else 1000
 learning_rate = 1.0e-4
 
 # Add this snippet before creating the train_loader
 import os
 
-if preconfigured_dataset is None:
+if preconfigured_dataset is None and not incremental:
     print("Number of training images:", len(os.listdir(train_data_paths)))
     print("Number of training labels:", len(os.listdir(train_label_paths)))
     print("Number of validation images:", len(os.listdir(val_data_paths)))
@@ -629,6 +980,133 @@ n_samples = 2
 
 check_trainer(trainer, n_samples, plt=True)
 
+"""## Test-time augmentation
+
+Predict with test-time augmentation (TTA): each tile is flipped / rotated with the 8 dihedral transformations (only the 4 flips for non-square tiles), all augmented copies are passed through the network as a single batch, and the predictions are mapped back and averaged. This usually gives cleaner masks at close to the latency of a single forward pass.
+
+The inverse transformations are applied to one augmentation at a time and summed into a preallocated output, which avoids stacking the inverted predictions. The network output for all augmented copies of a batch is still held in memory at once, so the peak memory grows with the number of augmentations. Set `tta_transforms_per_batch` to pass the augmented copies through the network in smaller chunks, which bounds the peak memory at the cost of more forward passes.
+"""
+
+# CONFIGURE ME
+use_tta = True
+n_samples = 2
+# None to predict all augmented copies in a single forward pass
+tta_transforms_per_batch = None
+
+import torch
+
+# (number of 90 degree rotations, horizontal flip) for the 8 elements of the dihedral group
+dihedral_transforms = [(k, flip) for flip in (False, True) for k in range(4)]
+
+def augment(x, k, flip):
+    if flip:
+        x = x.flip(-1)
+    return x.rot90(k, dims=(-2, -1))
+
+def deaugment(y, k, flip):
+    y = y.rot90(-k, dims=(-2, -1))
+    return y.flip(-1) if flip else y
+
+def predict_with_tta(model, tiles, transforms_per_batch=None):
+    """
+    Predict a batch of tiles (N x C x H x W) averaged over the dihedral flips / rotations.
+    """
+    # rotating by 90 degrees changes the shape of non-square tiles, so we can only stack the flips
+    square = tiles.shape[-1] == tiles.shape[-2]
+    transforms = [(k, flip) for k, flip in dihedral_transforms if square or k % 2 == 0]
+    if transforms_per_batch is None:
+        transforms_per_batch = len(transforms)
+
+    device = next(model.parameters()).device
+    tiles = tiles.to(device)
+    n_tiles = tiles.shape[0]
+
+    model.eval()
+    output = None
+    with torch.no_grad():
+        for start in range(0, len(transforms), transforms_per_batch):
+            chunk = transforms[start:start + transforms_per_batch]
+            prediction = model(torch.cat([augment(tiles, k, flip) for k, flip in chunk]))
+            if output is None:
+                output = torch.zeros((n_tiles,) + prediction.shape[1:], dtype=prediction.dtype, device=device)
+            for i, (k, flip) in enumerate(chunk):
+                output.add_(deaugment(prediction[i * n_tiles:(i + 1) * n_tiles], k, flip))
+    output.div_(len(transforms))
+    return output
+
+if use_tta:
+    model = trainer.model
+    device = next(model.parameters()).device
+    for i, (x, y) in enumerate(val_loader):
+        if i == n_samples:
+            break
+        y = y.to(device)
+        with torch.no_grad():
+            model.eval()
+            pred = model(x.to(device))
+        pred_tta = predict_with_tta(model, x, tta_transforms_per_batch)
+        print(f"Sample {i}: {metric} without TTA: {metric_function(pred, y).item():.4f}, with TTA: {metric_function(pred_tta, y).item():.4f}")
+
+"""## Update the manifest
+
+Validate the trained network on the raw image / mask pairs and store the score (`metric`, lower is better) together with the file hashes in the manifest, which is used by the incremental mode of the next run.
+The weights of the network are saved to `checkpoint_folder`, so that the next run can warm-start from the weights that belong to these scores.
+In incremental mode, only the new or changed images, the training images that had the worst score and the training images that were validated the longest time ago are validated again. The manifest counts the runs, and every image stores the run in which it was validated last (`validated_at`).
+"""
+
+def validate_image(model, raw_path, label_path):
+    raw = torch_em.transform.raw.standardize(imageio.imread(raw_path))
+    labels = imageio.imread(label_path)
+    if label_transform is not None:
+        labels = label_transform(labels)
+    if label_transform2 is not None:
+        labels = label_transform2(labels)
+
+    # the UNet needs a shape that is divisible by 2 ** depth, so we pad the image and crop the prediction;
+    # only the last two axes are padded, so that images with a leading channel axis, e.g. (1, H, W), also work
+    shape = raw.shape[-2:]
+    pad_width = [(0, 0)] * (raw.ndim - 2) + [(0, (-sh) % 2 ** depth) for sh in shape]
+    raw = torch_em.util.ensure_tensor_with_channels(np.pad(raw, pad_width, mode="reflect"), ndim=2).float()
+    labels = torch_em.util.ensure_tensor_with_channels(labels, ndim=2).float()
+
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        pred = model(raw[None].to(device))[..., :shape[0], :shape[1]]
+    return metric_function(pred, labels[None].to(device)).item()
+
+if preconfigured_dataset is None:
+    run = manifest.get("run", 0) + 1
+    to_validate = set(image_files)
+    if incremental and not revalidate_all:
+        # only the training images are sampled by their score, so only their scores need to be refreshed
+        previous = {
+            key: image for key, image in manifest["images"].items() if key in image_files and key.startswith("train/")
+        }
+        worst = sorted(previous, key=lambda key: previous[key]["score"], reverse=True)[:n_revalidate_worst]
+        oldest = sorted(previous, key=lambda key: previous[key].get("validated_at", 0))[:n_revalidate_oldest]
+        to_validate = changed_images | set(worst) | set(oldest)
+
+    model = trainer.model
+    model.eval()
+    images = {}
+    for key, (raw_path, label_path) in image_files.items():
+        if key in to_validate:
+            score, validated_at = validate_image(model, raw_path, label_path), run
+        else:
+            score, validated_at = manifest["images"][key]["score"], manifest["images"][key].get("validated_at", 0)
+        images[key] = {
+            "hashes": image_hashes[key], "stats": image_stats[key], "score": score, "validated_at": validated_at
+        }
+    print("Validated", len(to_validate), "of", len(image_files), "images")
+
+    # the checkpoint in ./checkpoints is lost when the colab session ends, so we save the weights next to the manifest
+    os.makedirs(checkpoint_folder, exist_ok=True)
+    checkpoint_path = os.path.join(checkpoint_folder, f"{experiment_name}.pt")
+    torch.save({"model_state": model.state_dict()}, checkpoint_path)
+
+    with open(manifest_path, "w") as f:
+        json.dump({"checkpoint": checkpoint_path, "run": run, "images": images}, f, indent=2)
+
 """## Export network to bioimage.io format
 
 Finally, you can export the trained model in the format compatible with [BioImage.IO](https://bioimage.io/#/), a modelzoo for bioimage analysis. After exporting, you can upload the model there to share it with other researchers.